@@ -1,14 +1,36 @@
 import os
 import asyncio
 import aiohttp
-import base64
+import httpx
 import logging
+import time
 import uuid
+from collections import OrderedDict
 from io import BytesIO
 from typing import Optional, List
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from PIL import Image, ImageOps
+
+try:
+    import pybase64 as base64  # SIMD-accelerated, drop-in replacement
+except ImportError:
+    import base64
+
+try:
+    import orjson
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    import json
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    json_loads = json.loads
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
 
 # Configure logging
 logging.basicConfig(
@@ -19,41 +41,166 @@ logger = logging.getLogger(__name__)
 
 # Model configurations
 MODELS = {
-    "flux": {"id": "runware:101@1", "name": "FLUX Dev", "supports_reference": False},
-    "hidream": {"id": "runware:97@2", "name": "HiDream Pro", "supports_reference": False},
-    "kontext": {"id": "bfl:3@1", "name": "Kontext Pro", "supports_reference": True},
-    "kontext-max": {"id": "bfl:4@1", "name": "Kontext Max", "supports_reference": True},
-    "fast": {"id": "runware:100@1", "name": "FLUX Schnell", "supports_reference": False}
+    "flux": {"id": "runware:101@1", "name": "FLUX Dev", "family": "flux", "supports_reference": False},
+    "hidream": {"id": "runware:97@2", "name": "HiDream Pro", "family": "flux", "supports_reference": False},
+    "kontext": {"id": "bfl:3@1", "name": "Kontext Pro", "family": "bfl", "supports_reference": True},
+    "kontext-max": {"id": "bfl:4@1", "name": "Kontext Max", "family": "bfl", "supports_reference": True},
+    "fast": {"id": "runware:100@1", "name": "FLUX Schnell", "family": "flux", "supports_reference": False}
 }
 
+# Model family by Runware model id
+_MODEL_FAMILIES = {model["id"]: model["family"] for model in MODELS.values()}
+
+# Output size (width, height) by model family and orientation
+_DIMENSIONS = {
+    ("bfl", "landscape"): (1392, 752),
+    ("bfl", "portrait"): (752, 1392),
+    ("bfl", "square"): (1024, 1024),
+    ("flux", "landscape"): (1344, 704),  # FLUX and HiDream
+    ("flux", "portrait"): (704, 1344),
+    ("flux", "square"): (1024, 1024),
+}
+
+# Largest side Kontext accepts for reference images; bigger inputs are only extra upload bytes
+REFERENCE_IMAGE_MAX_SIDE = 1392
+
+# Largest side of the previews sent for multi-image batches
+PREVIEW_MAX_SIDE = 1024
+
+# Minimum seconds between progress edits of the status message during a batch
+PROGRESS_EDIT_INTERVAL = 2.0
+
+# Concurrent generations per batch; the cap is per request, so one large batch doesn't queue other users
+BATCH_CONCURRENCY = 5
+
+def prepare_reference_image(content: bytes) -> bytes:
+    """Downscale a reference image to the Kontext input size and re-encode it as JPEG without EXIF"""
+    with Image.open(BytesIO(content)) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((REFERENCE_IMAGE_MAX_SIDE, REFERENCE_IMAGE_MAX_SIDE))
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+def shrink_image(image_bytes: bytes, max_side: int = PREVIEW_MAX_SIDE) -> bytes:
+    """Downscale an image to fit within max_side and re-encode it as JPEG, if it is larger"""
+    with Image.open(BytesIO(image_bytes)) as image:
+        if max(image.size) <= max_side:
+            return image_bytes
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+def _bytes_to_b64(data: bytes) -> str:
+    """Encode bytes as base64 text, only needed for images embedded in Runware JSON payloads"""
+    return base64.b64encode(data).decode('ascii')
+
+def encode_reference_image(content: bytes) -> str:
+    """Prepare a reference image and return it as a raw base64 string"""
+    return _bytes_to_b64(prepare_reference_image(content))
+
 class ImageBot:
+    # Maximum number of encoded reference images kept in memory
+    FILE_CACHE_MAXSIZE = 128
+
     def __init__(self):
         self.api_key = os.getenv("RUNWARE_API_KEY")
         self.api_url = "https://api.runware.ai/v1"
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._h2_client: Optional[httpx.AsyncClient] = None
+        # LRU cache of Telegram file_id -> {"base64": raw base64, "uuid": Runware image UUID or None},
+        # so re-editing a photo skips the download and, once uploaded, the base64 upload too
+        self._file_cache: OrderedDict[str, dict] = OrderedDict()
+        # Generations currently running, so identical concurrent requests share one upstream call;
+        # each entry is {"task": shared task, "waiters": number of callers awaiting it}
+        self._inflight: dict[tuple, dict] = {}
+
+    async def start(self):
+        """Create the shared HTTP clients used for all outgoing requests"""
+        connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=16,
+            ttl_dns_cache=300,
+            keepalive_timeout=75
+        )
+        self._session = aiohttp.ClientSession(connector=connector)
+        # Runware API calls all go to one host, so multiplex them over HTTP/2
+        self._h2_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10),
+            # Generations can take a while; match aiohttp's default 5 minute budget
+            timeout=httpx.Timeout(300.0, connect=10.0)
+        )
 
-    def get_dimensions(self, model_id: str, orientation: str = "portrait") -> tuple:
-        """Get width and height based on model and orientation"""
-        if orientation.lower() == "square":
-            return 1024, 1024  # Square: width = height
-        elif "bfl" in model_id:  # Kontext
-            if orientation.lower() == "landscape":
-                return 1392, 752  # Landscape: width > height
-            else:
-                return 752, 1392  # Portrait: height > width
-        else:  # FLUX and HiDream
-            if orientation.lower() == "landscape":
-                return 1344, 704  # Landscape: width > height
-            else:
-                return 704, 1344  # Portrait: height > width
-
-    async def generate_image(self, prompt: str, model_id: str, orientation: str = "portrait", reference_image_base64: Optional[str] = None) -> Optional[str]:
+    async def close(self):
+        """Close the shared HTTP clients"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._h2_client is not None:
+            await self._h2_client.aclose()
+            self._h2_client = None
+
+    @staticmethod
+    async def _read_chunked(response: aiohttp.ClientResponse, chunk_size: int = 64 * 1024) -> bytes:
+        """Read a response body in bounded chunks into a single buffer"""
+        buffer = BytesIO()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            buffer.write(chunk)
+        return buffer.getvalue()
+
+    def get_dimensions(self, family: str, orientation: str = "portrait") -> tuple:
+        """Get width and height based on model family and orientation"""
+        return _DIMENSIONS[(family, orientation.lower())]
+
+    async def generate_image(self, prompt: str, model_id: str, orientation: str = "portrait", reference_image: Optional[str] = None, variant: int = 0, reference_key: Optional[str] = None, batch_limit: Optional[asyncio.Semaphore] = None) -> Optional[bytes]:
+        """Generate image using Runware HTTP API, holding a slot of the caller's batch_limit if given"""
+        if batch_limit is None:
+            return await self._generate_image_shared(prompt, model_id, orientation, reference_image, variant, reference_key)
+        async with batch_limit:
+            return await self._generate_image_shared(prompt, model_id, orientation, reference_image, variant, reference_key)
+
+    async def _generate_image_shared(self, prompt: str, model_id: str, orientation: str = "portrait", reference_image: Optional[str] = None, variant: int = 0, reference_key: Optional[str] = None) -> Optional[bytes]:
+        """Generate image using Runware HTTP API, sharing identical in-flight requests"""
+        # variant tells apart the images of one batch, which would otherwise share a key.
+        # reference_key (the Telegram file_id) identifies the reference image, since
+        # reference_image may be either its base64 or its Runware upload UUID
+        key = (prompt, model_id, orientation, reference_key if reference_key is not None else reference_image, variant)
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.create_task(self._generate_image(prompt, model_id, orientation, reference_image))
+            entry = {"task": task, "waiters": 0}
+            self._inflight[key] = entry
+            task.add_done_callback(lambda _: self._forget_inflight(key, entry))
+        task = entry["task"]
+
+        entry["waiters"] += 1
+        try:
+            # Shield the shared task so one caller being cancelled doesn't fail the others
+            return await asyncio.shield(task)
+        finally:
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not task.done():
+                # The last caller was cancelled: stop the upstream generation as well
+                self._forget_inflight(key, entry)
+                task.cancel()
+
+    def _forget_inflight(self, key: tuple, entry: dict):
+        """Remove an in-flight entry, unless a newer request has replaced it"""
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    async def _generate_image(self, prompt: str, model_id: str, orientation: str = "portrait", reference_image: Optional[str] = None) -> Optional[bytes]:
         """Generate image using Runware HTTP API"""
         try:
             # Generate a unique task UUID
             task_uuid = str(uuid.uuid4())
 
-            # Get dimensions based on model and orientation
-            width, height = self.get_dimensions(model_id, orientation)
+            # Get dimensions based on model family and orientation
+            family = _MODEL_FAMILIES[model_id]
+            width, height = self.get_dimensions(family, orientation)
 
             # Prepare the payload
             payload = [
@@ -68,93 +215,154 @@ class ImageBot:
                     "width": width,
                     "height": height,
                     "model": model_id,
-                    "outputFormat": "JPEG",
+                    "outputFormat": "WEBP",
                     "includeCost": True,
                     "outputType": ["URL"],
                     "numberResults": 1
                 }
             ]
 
-            # Add reference image as raw base64 (not data URI)
-            if reference_image_base64 and "bfl" in model_id:
-                payload[1]["referenceImages"] = [reference_image_base64]
-
-            # Make the HTTP request
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_url,
-                    json=payload,
-                    headers={"Content-Type": "application/json"}
-                ) as response:
-
-                    if response.status != 200:
-                        logger.error(f"API request failed with status {response.status}")
-                        response_text = await response.text()
-                        logger.error(f"Response: {response_text}")
-                        return None
-
-                    result = await response.json()
-                    logger.info(f"API Response: {result}")
-
-                    # Check for errors in the response
-                    if isinstance(result, list):
-                        for item in result:
-                            if "error" in item:
-                                logger.error(f"API returned error: {item['error']}")
-                                return None
-                    elif "error" in result:
-                        logger.error(f"API returned error: {result['error']}")
+            # Add reference image as an uploaded image UUID or raw base64 (not data URI)
+            if reference_image and family == "bfl":
+                payload[1]["referenceImages"] = [reference_image]
+
+            # Make the HTTP request, multiplexed over the shared HTTP/2 connection
+            response = await self._h2_client.post(
+                self.api_url,
+                content=json_dumps(payload),
+                headers={"Content-Type": "application/json"}
+            )
+
+            if response.status_code != 200:
+                logger.error(f"API request failed with status {response.status_code}")
+                response_text = response.text
+                logger.error(f"Response: {response_text}")
+                return None
+
+            result = json_loads(response.content)
+            logger.info(f"API Response: {result}")
+
+            # Check for errors in the response
+            if isinstance(result, list):
+                for item in result:
+                    if "error" in item:
+                        logger.error(f"API returned error: {item['error']}")
                         return None
-
-                    # Extract image URL from response
-                    items_to_check = result if isinstance(result, list) else result.get("data", [])
-
-                    for item in items_to_check:
-                        if (item.get("taskType") == "imageInference" and 
-                            item.get("taskUUID") == task_uuid and 
-                            "imageURL" in item):
-                            image_url = item.get("imageURL")
-                            if image_url:
-                                # Download the image and convert to base64
-                                return await self.download_image_as_base64(image_url)
-
-                    logger.error("No image URL found in API response")
-                    logger.error(f"Full response: {result}")
-                    return None
+            elif "error" in result:
+                logger.error(f"API returned error: {result['error']}")
+                return None
+
+            # Extract image URL from response
+            items_to_check = result if isinstance(result, list) else result.get("data", [])
+
+            for item in items_to_check:
+                if (item.get("taskType") == "imageInference" and 
+                    item.get("taskUUID") == task_uuid and 
+                    "imageURL" in item):
+                    image_url = item.get("imageURL")
+                    if image_url:
+                        # Download the raw image bytes
+                        return await self.download_image_bytes(image_url)
+
+            logger.error("No image URL found in API response")
+            logger.error(f"Full response: {result}")
+            return None
 
         except Exception as e:
             logger.error(f"Error generating image: {e}")
             return None
 
-    async def download_image_as_base64(self, image_url: str) -> Optional[str]:
-        """Download image from URL and convert to base64"""
+    async def download_image_bytes(self, image_url: str) -> Optional[bytes]:
+        """Download image from URL and return its raw bytes"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_url) as response:
-                    if response.status == 200:
-                        content = await response.read()
-                        return base64.b64encode(content).decode('utf-8')
-                    else:
-                        logger.error(f"Failed to download image: HTTP {response.status}")
-                        return None
+            async with self._session.get(image_url) as response:
+                if response.status == 200:
+                    return await self._read_chunked(response)
+                else:
+                    logger.error(f"Failed to download image: HTTP {response.status}")
+                    return None
         except Exception as e:
             logger.error(f"Error downloading image: {e}")
             return None
 
+    def get_uploaded_reference(self, file_id: str) -> Optional[str]:
+        """Return the Runware image UUID of an already uploaded Telegram photo, if any"""
+        entry = self._file_cache.get(file_id)
+        return entry["uuid"] if entry else None
+
+    def forget_uploaded_reference(self, file_id: str):
+        """Drop the cached Runware image UUID of a Telegram photo, e.g. after it stopped working"""
+        entry = self._file_cache.get(file_id)
+        if entry:
+            entry["uuid"] = None
+
+    async def upload_reference_image(self, file_id: str, image_base64: str) -> Optional[str]:
+        """Upload a reference image to Runware and return its image UUID, cached per file_id"""
+        uploaded_uuid = self.get_uploaded_reference(file_id)
+        if uploaded_uuid:
+            return uploaded_uuid
+
+        try:
+            task_uuid = str(uuid.uuid4())
+            payload = [
+                {
+                    "taskType": "authentication",
+                    "apiKey": self.api_key
+                },
+                {
+                    "taskType": "imageUpload",
+                    "taskUUID": task_uuid,
+                    "image": f"data:image/jpeg;base64,{image_base64}"
+                }
+            ]
+
+            response = await self._h2_client.post(
+                self.api_url,
+                content=json_dumps(payload),
+                headers={"Content-Type": "application/json"}
+            )
+
+            if response.status_code != 200:
+                logger.error(f"Image upload failed with status {response.status_code}")
+                logger.error(f"Response: {response.text}")
+                return None
+
+            result = json_loads(response.content)
+            items_to_check = result if isinstance(result, list) else result.get("data", [])
+
+            for item in items_to_check:
+                if item.get("taskUUID") == task_uuid and item.get("imageUUID"):
+                    if file_id in self._file_cache:
+                        self._file_cache[file_id]["uuid"] = item["imageUUID"]
+                    return item["imageUUID"]
+
+            logger.error(f"No image UUID found in upload response: {result}")
+            return None
+
+        except Exception as e:
+            logger.error(f"Error uploading reference image: {e}")
+            return None
+
     async def upload_telegram_image(self, file_id: str, bot) -> Optional[str]:
         """Upload Telegram image and return raw base64"""
+        if file_id in self._file_cache:
+            self._file_cache.move_to_end(file_id)
+            return self._file_cache[file_id]["base64"]
+
         try:
             # Get file from Telegram
             file = await bot.get_file(file_id)
 
             # Download file content
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file.file_path) as response:
-                    if response.status == 200:
-                        content = await response.read()
-                        # Return raw base64 string
-                        image_base64 = base64.b64encode(content).decode('utf-8')
-                        return image_base64
+            async with self._session.get(file.file_path) as response:
+                if response.status == 200:
+                    content = await self._read_chunked(response)
+                    # Resize and encode in a worker thread so large photos don't block the event loop
+                    image_base64 = await asyncio.to_thread(encode_reference_image, content)
+                    self._file_cache[file_id] = {"base64": image_base64, "uuid": None}
+                    if len(self._file_cache) > self.FILE_CACHE_MAXSIZE:
+                        self._file_cache.popitem(last=False)
+                    return image_base64
 
             return None
         except Exception as e:
@@ -164,54 +372,50 @@ class ImageBot:
 # Initialize bot instance
 image_bot = ImageBot()
 
+# Orientation selected by each orientation flag
+_FLAG_ACTIONS = {
+    "--landscape": "landscape", "-l": "landscape",
+    "--portrait": "portrait", "-p": "portrait",
+    "--square": "square", "-s": "square",
+}
+_MAX_FLAGS = frozenset({"--max", "-max"})
+
 def parse_command_args(args: List[str]) -> tuple:
     """Parse command arguments to extract orientation, number of images, and prompt"""
     orientation = "portrait"  # default
     num_images = 1  # default
     use_max = False  # default
-    prompt_args = args.copy()
+    prompt_args = []  # tokens that are not options, in order
 
+    # Single forward scan: options are skipped, everything else is kept for the prompt
     i = 0
-    while i < len(prompt_args):
-        arg = prompt_args[i].lower()
-        if arg in ['--landscape', '-l']:
-            orientation = "landscape"
-            prompt_args.pop(i)
-            # Don't increment i since we removed an item
-        elif arg in ['--portrait', '-p']:
-            orientation = "portrait"
-            prompt_args.pop(i)
-            # Don't increment i since we removed an item
-        elif arg in ['--square', '-s']:
-            orientation = "square"
-            prompt_args.pop(i)
-            # Don't increment i since we removed an item
-        elif arg in ['--max', '-max']:
+    while i < len(args):
+        arg = args[i].lower()
+        if (flag_orientation := _FLAG_ACTIONS.get(arg)) is not None:
+            orientation = flag_orientation
+        elif arg in _MAX_FLAGS:
             use_max = True
-            prompt_args.pop(i)
-            # Don't increment i since we removed an item
-        elif arg == '-n' and i + 1 < len(prompt_args):
+        elif arg == '-n' and i + 1 < len(args):
             try:
-                num_images = int(prompt_args[i + 1])
+                num_images = int(args[i + 1])
                 if num_images < 1:
                     num_images = 1
                 elif num_images > 10:  # Limit to 10 images max
                     num_images = 10
-                prompt_args.pop(i)  # Remove -n
-                prompt_args.pop(i)  # Remove the number (now at index i)
-                # Don't increment i since we removed two items
-            except (ValueError, IndexError):
-                # If conversion fails or index is out of range, skip this argument
-                i += 1
+                i += 2  # Skip -n and the number
+                continue
+            except ValueError:
+                # If conversion fails, keep -n as part of the prompt
+                prompt_args.append(args[i])
         else:
-            i += 1
+            prompt_args.append(args[i])
+        i += 1
 
     prompt = " ".join(prompt_args)
     return orientation, num_images, use_max, prompt
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Start command handler"""
-    welcome_text = """
+# Welcome message for /start
+_START_TEXT = """
 🦑 **Cuttlefish**
 
 I can generate amazing images using different AI models:
@@ -239,7 +443,29 @@ Send an image with a caption describing the changes you want to make!
 
 Example: Send a photo with caption "Turn this into a pencil sketch"
     """
-    await update.message.reply_text(welcome_text, parse_mode='Markdown')
+
+# Usage hint sent in reply to plain text messages
+_HELP_TEXT = (
+    "🦑 **Cuttlefish**\n\n"
+    "💡 To generate an image, use:\n"
+    "• `/flux <prompt>` - Use FLUX Dev\n"
+    "• `/hidream <prompt>` - Use HiDream Pro\n"
+    "• `/kontext <prompt>` - Use Kontext Pro\n"
+    "• `/fast <prompt>` - Use FLUX Schnell\n\n"
+    "**Options:**\n"
+    "• Add `--landscape` or `-l` for landscape\n"
+    "• Add `--portrait` or `-p` for portrait (default)\n"
+    "• Add `--square` or `-s` for square (1024x1024)\n"
+    "• Add `-n <number>` to generate multiple images (max 10)\n\n"
+    "**Examples:**\n"
+    "• `/flux --landscape -n 2 a sunset` (2 landscape images)\n"
+    "• `/flux -s a sunset` (square image)\n\n"
+    "Or send an image with a caption to edit it! Example: `-s -n 3 -max Turn this into a pencil sketch`. The `-max` option uses kontext max."
+)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start command handler"""
+    await update.message.reply_text(_START_TEXT, parse_mode='Markdown')
 
 async def generate_flux(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Generate image with FLUX model"""
@@ -282,6 +508,7 @@ async def generate_image_direct(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     model = MODELS[model_key]
+    model_id = model["id"]
 
     # Send generating message with orientation and number info
     orientation_text = "🖼️ Landscape" if orientation == "landscape" else "📱 Portrait" if orientation == "portrait" else "⬛ Square"
@@ -292,24 +519,43 @@ async def generate_image_direct(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
     try:
-        # Generate multiple images
-        for i in range(num_images):
-            image_base64 = await image_bot.generate_image(prompt, model["id"], orientation)
-
-            if image_base64:
-                # Convert base64 to bytes and send
-                image_bytes = base64.b64decode(image_base64)
-                caption = f"🎨 Generated with {model['name']} ({orientation_text})\n*Prompt:* {prompt}"
-                if num_images > 1:
-                    caption += f"\n*Image {i+1} of {num_images}*"
-                await update.message.reply_photo(
-                    photo=BytesIO(image_bytes),
-                    caption=caption,
-                    parse_mode='Markdown'
-                )
-            else:
-                await generating_msg.edit_text("❌ Failed to generate image. Please try again.")
-                return
+        # Generate multiple images concurrently and send each one as soon as it is ready
+        batch_limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(image_bot.generate_image(prompt, model_id, orientation, variant=i, batch_limit=batch_limit))
+            for i in range(num_images)
+        ]
+        last_edit = time.monotonic()
+        try:
+            for i, next_image in enumerate(asyncio.as_completed(tasks)):
+                image_bytes = await next_image
+
+                if image_bytes:
+                    caption = f"🎨 Generated with {model['name']} ({orientation_text})\n*Prompt:* {prompt}"
+                    if num_images > 1:
+                        caption += f"\n*Image {i+1} of {num_images}*"
+                        # Send smaller previews for batches to cut upload time
+                        image_bytes = await asyncio.to_thread(shrink_image, image_bytes)
+                    await update.message.reply_photo(
+                        photo=BytesIO(image_bytes),
+                        caption=caption,
+                        parse_mode='Markdown'
+                    )
+                    # Throttle progress updates to spare Telegram round-trips
+                    if i + 1 < num_images and time.monotonic() - last_edit > PROGRESS_EDIT_INTERVAL:
+                        try:
+                            await generating_msg.edit_text(f"⏳ {i+1}/{num_images} ready...")
+                        except TelegramError as e:
+                            # A failed progress update must not abort the batch
+                            logger.warning(f"Failed to update progress message: {e}")
+                        last_edit = time.monotonic()
+                else:
+                    await generating_msg.edit_text("❌ Failed to generate image. Please try again.")
+                    return
+        finally:
+            # Stop any generations still running after a failure
+            for task in tasks:
+                task.cancel()
 
         await generating_msg.delete()
 
@@ -332,14 +578,18 @@ async def handle_photo_with_caption(update: Update, context: ContextTypes.DEFAUL
     orientation, num_images, use_max, prompt = parse_command_args(caption_args)
 
     if not prompt:
-        prompt = caption  # Use original caption if no parsing found
-        orientation = "portrait"  # Default orientation
-        num_images = 1  # Default number of images
-        use_max = False  # Default model
+        # The caption only held options; don't send them to the model as the edit instruction
+        await update.message.reply_text(
+            "Please provide a prompt after the options!\n"
+            "Example: `-l -n 2 Turn this into a pencil sketch`",
+            parse_mode='Markdown'
+        )
+        return
 
     # Select model based on -max flag
     model_key = "kontext-max" if use_max else "kontext"
     model = MODELS[model_key]
+    model_id = model["id"]
 
     # Send processing message with number and orientation info
     orientation_text = "🖼️ Landscape" if orientation == "landscape" else "📱 Portrait" if orientation == "portrait" else "⬛ Square"
@@ -359,31 +609,64 @@ async def handle_photo_with_caption(update: Update, context: ContextTypes.DEFAUL
             await processing_msg.edit_text("❌ Failed to process the reference image.")
             return
 
+        # Reuse an earlier Runware upload of this photo. For batches, upload it now so each request
+        # only sends the UUID; single edits embed the base64, as does any rejected upload
+        reference_image = image_bot.get_uploaded_reference(photo.file_id)
+        if reference_image is None and num_images > 1:
+            reference_image = await image_bot.upload_reference_image(photo.file_id, reference_image_base64)
+        if not reference_image:
+            reference_image = reference_image_base64
+
         # Update processing message
         await processing_msg.edit_text(
             f"🎨 Editing image with {model['name']} ({orientation_text})...\n*Changes:* {prompt}\n*Generating {num_text}...*",
             parse_mode='Markdown'
         )
 
-        # Generate multiple edited images
-        for i in range(num_images):
-            image_base64 = await image_bot.generate_image(prompt, MODELS[model_key]["id"], orientation, reference_image_base64)
-
-            if image_base64:
-                # Convert base64 to bytes and send
-                image_bytes = base64.b64decode(image_base64)
-                caption_text = f"✨ Edited with {model['name']} ({orientation_text})\n**Changes:** {prompt}"
-                if num_images > 1:
-                    caption_text += f"\n*Image {i+1} of {num_images}*"
-
-                await update.message.reply_photo(
-                    photo=BytesIO(image_bytes),
-                    caption=caption_text,
-                    parse_mode='Markdown'
-                )
-            else:
-                await processing_msg.edit_text("❌ Failed to edit image. Please try again.")
-                return
+        # Generate multiple edited images concurrently and send each one as soon as it is ready
+        batch_limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(image_bot.generate_image(prompt, model_id, orientation, reference_image, variant=i, reference_key=photo.file_id, batch_limit=batch_limit))
+            for i in range(num_images)
+        ]
+        last_edit = time.monotonic()
+        try:
+            for i, next_image in enumerate(asyncio.as_completed(tasks)):
+                image_bytes = await next_image
+
+                if not image_bytes and reference_image is not reference_image_base64:
+                    # The uploaded reference may have expired or been rejected: forget it and
+                    # retry this image once with the base64 (keyed on it, not on the file_id)
+                    image_bot.forget_uploaded_reference(photo.file_id)
+                    image_bytes = await image_bot.generate_image(prompt, model_id, orientation, reference_image_base64, variant=i, batch_limit=batch_limit)
+
+                if image_bytes:
+                    caption_text = f"✨ Edited with {model['name']} ({orientation_text})\n**Changes:** {prompt}"
+                    if num_images > 1:
+                        caption_text += f"\n*Image {i+1} of {num_images}*"
+                        # Send smaller previews for batches to cut upload time
+                        image_bytes = await asyncio.to_thread(shrink_image, image_bytes)
+
+                    await update.message.reply_photo(
+                        photo=BytesIO(image_bytes),
+                        caption=caption_text,
+                        parse_mode='Markdown'
+                    )
+                    # Throttle progress updates to spare Telegram round-trips
+                    if i + 1 < num_images and time.monotonic() - last_edit > PROGRESS_EDIT_INTERVAL:
+                        try:
+                            await processing_msg.edit_text(f"⏳ {i+1}/{num_images} ready...")
+                        except TelegramError as e:
+                            # A failed progress update must not abort the batch
+                            logger.warning(f"Failed to update progress message: {e}")
+                        last_edit = time.monotonic()
+                else:
+                    await processing_msg.edit_text("❌ Failed to edit image. Please try again.")
+                    return
+        finally:
+            # Stop any generations still running after a failure
+            for task in tasks:
+                task.cancel()
 
         await processing_msg.delete()
 
@@ -396,24 +679,18 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = update.message.text.strip()
     if text and not text.startswith('/'):
         await update.message.reply_text(
-            "🦑 **Cuttlefish**\n\n"
-            "💡 To generate an image, use:\n"
-            "• `/flux <prompt>` - Use FLUX Dev\n"
-            "• `/hidream <prompt>` - Use HiDream Pro\n"
-            "• `/kontext <prompt>` - Use Kontext Pro\n"
-            "• `/fast <prompt>` - Use FLUX Schnell\n\n"
-            "**Options:**\n"
-            "• Add `--landscape` or `-l` for landscape\n"
-            "• Add `--portrait` or `-p` for portrait (default)\n"
-            "• Add `--square` or `-s` for square (1024x1024)\n"
-            "• Add `-n <number>` to generate multiple images (max 10)\n\n"
-            "**Examples:**\n"
-            "• `/flux --landscape -n 2 a sunset` (2 landscape images)\n"
-            "• `/flux -s a sunset` (square image)\n\n"
-            "Or send an image with a caption to edit it! Example: `-s -n 3 -max Turn this into a pencil sketch`. The `-max` option uses kontext max.",
+            _HELP_TEXT,
             parse_mode='Markdown'
         )
 
+async def post_init(application: Application):
+    """Open the shared HTTP clients once the event loop is running"""
+    await image_bot.start()
+
+async def post_shutdown(application: Application):
+    """Close the shared HTTP clients on shutdown"""
+    await image_bot.close()
+
 def main():
     """Main function to run the bot"""
     # Get bot token from environment
@@ -426,7 +703,19 @@ def main():
         raise ValueError("RUNWARE_API_KEY environment variable is required")
 
     # Create application
-    application = Application.builder().token(bot_token).build()
+    application = (
+        Application.builder()
+        .token(bot_token)
+        # HTTP/2 and a larger pool so bursts of reply_photo uploads reuse connections
+        .http_version("2")
+        .connection_pool_size(32)
+        .pool_timeout(10)
+        .connect_timeout(10)
+        .read_timeout(60)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))